@@ -1,3 +1,8 @@
+import collections
+import operator
+import struct
+import weakref
+
 has_aioserial = False
 try:
 	import aioserial
@@ -5,207 +10,518 @@ try:
 except ModuleNotFoundError:
 	pass
 
+# Cython build of calcCRC and the receive frame scan, see
+# _SimpleComm_fast.pyx
+has_fast = False
+try:
+	import _SimpleComm_fast
+	has_fast = True
+except ImportError:
+	# Also raised when the extension was built for another Python
+	pass
+
+# The compiled CRC kernels below take numpy views; with the Cython module
+# they are not needed
+has_numpy = False
+if not has_fast:
+	try:
+		import numpy
+		has_numpy = True
+	except ImportError:
+		pass
+
+def _crcSum(buffer, start, end):
+	s = 0
+	for i in range(start, end):
+		s += buffer[i]
+	return s & 0xff
+
+# Compiled _crcSum, called with a uint8 numpy view of the buffer. The
+# extension built by build_ext.py is preferred, as it does not need numba
+# at runtime; otherwise it is jitted if numba is available
+_crcKernel = None
+if has_numpy:
+	try:
+		from _SimpleComm_cc import crcSum as _crcKernel
+	except ImportError:
+		# Also raised when the extension was built against another numpy
+		pass
+
+has_numba = False
+if has_numpy and _crcKernel == None:
+	try:
+		import numba
+		has_numba = True
+		_crcKernel = numba.njit(cache = True, boundscheck = False)(_crcSum)
+	except ImportError:
+		# Also raised when numba is installed against an incompatible numpy
+		pass
+
+SYN = 0x02
+
+_integerStructs = {
+	(1, False): struct.Struct("<B"),
+	(1, True): struct.Struct("<b"),
+	(2, False): struct.Struct("<H"),
+	(2, True): struct.Struct("<h"),
+	(4, False): struct.Struct("<I"),
+	(4, True): struct.Struct("<i"),
+	(8, False): struct.Struct("<Q"),
+	(8, True): struct.Struct("<q"),
+}
+
+# Released packets, reused by the receive functions
+_packetPool = collections.deque(maxlen = 32)
+
 class SimplePacket:
+	# The packet is kept in its wire layout so it can be sent without copying:
+	# SYN, length, destination, source, type, data..., CRC
+	_INDEX_SYN = 0
+	_INDEX_LEN = 1
+	_INDEX_DESTINATION = 2
+	_INDEX_SOURCE = 3
+	_INDEX_TYPE = 4
+	_INDEX_DATA = 5
+
+	MAX_DATA_LEN = 0xff - 4
+
+	# An empty packet; copying it is cheaper than allocating and then
+	# writing the header
+	_TEMPLATE = bytes((SYN, 4)) + bytes(_INDEX_DATA - 2 + MAX_DATA_LEN + 1)
+
 	def __init__(self):
-		self.source = 0
-		self.destination = 0
-		self.type = 0
-		self.data = bytearray()
+		self._data = bytearray(SimplePacket._TEMPLATE)
+		self._released = False
 
 	def getSource(self):
-		return self.source
+		return self._data[SimplePacket._INDEX_SOURCE]
 
 	def setSource(self, source):
-		self.source = int(source)
+		self._data[SimplePacket._INDEX_SOURCE] = int(source)
 
 	def getDestination(self):
-		return self.destination
+		return self._data[SimplePacket._INDEX_DESTINATION]
 
 	def setDestination(self, destination):
-		self.destination = int(destination)
+		self._data[SimplePacket._INDEX_DESTINATION] = int(destination)
 
 	def getType(self):
-		return self.type
+		return self._data[SimplePacket._INDEX_TYPE]
 
 	def setType(self, type):
-		self.type = int(type)
+		self._data[SimplePacket._INDEX_TYPE] = int(type)
 
 	def getData(self):
-		return self.data
+		return self._data[SimplePacket._INDEX_DATA:SimplePacket._INDEX_DATA + self._dataLen()]
 
 	def setData(self, data):
-		self.data = bytearray(data);
+		n = len(data)
+		if n > SimplePacket.MAX_DATA_LEN:
+			raise ValueError("data too long: {0} > {1} bytes".format(n, SimplePacket.MAX_DATA_LEN))
+
+		self._data[SimplePacket._INDEX_DATA:SimplePacket._INDEX_DATA + n] = data
+		self._data[SimplePacket._INDEX_LEN] = n + 4
 
 	def setChar(self, value, signed = True):
-		self.data = value.to_bytes(1, byteorder = "little", signed = signed)
+		self._setInteger(value, 1, signed)
 
 	def setShort(self, value, signed = True):
-		self.data = value.to_bytes(2, byteorder = "little", signed = signed)
+		self._setInteger(value, 2, signed)
 
 	def setInt(self, value, signed = True):
-		self.data = value.to_bytes(4, byteorder = "little", signed = signed)
+		self._setInteger(value, 4, signed)
 
 	def setLong(self, value, signed = True):
-		self.data = value.to_bytes(8, byteorder = "little", signed = signed)
+		self._setInteger(value, 8, signed)
 
 	def setString(self, value):
-		self.data = bytearray(value, "utf-8")
-		self.data.append(0x00)
+		data = bytearray(value, "utf-8")
+		data.append(0x00)
+		self.setData(data)
 
 	def getChar(self, signed = True):
-		return int.from_bytes(self.data[:1], byteorder = "little", signed = signed)
+		return self._getInteger(1, signed)
 
 	def getShort(self, signed = True):
-		return int.from_bytes(self.data[:2], byteorder = "little", signed = signed)
+		return self._getInteger(2, signed)
 
 	def getInt(self, signed = True):
-		return int.from_bytes(self.data[:4], byteorder = "little", signed = signed)
+		return self._getInteger(4, signed)
 
 	def getLong(self, signed = True):
-		return int.from_bytes(self.data[:8], byteorder = "little", signed = signed)
+		return self._getInteger(8, signed)
 
 	def getString(self):
-		return self.data[0:-1].decode(encoding = "utf-8", errors = "ignore")
-
-class SimpleComm:
-	SYN = 0x02
-	address = 0
-
-	def __init__(self, address = 0):
-		SimpleComm.setAddress(address)
-
-	def setAddress(address):
-		SimpleComm.address = address
-
-	def getAddress():
-		return SimpleComm.address
-
-	async def async_send(stream, packet, destination = None, type = None):
-		packet.setSource(SimpleComm.getAddress())
-
-		if destination != None:
-			packet.setDestination(destination)
-
-		if type != None:
-			packet.setType(type)
-
-		data = packet.getData()
-		buffer = bytearray()
-		buffer.append(SimpleComm.SYN)
-		buffer.append(len(data) + 4)
-		buffer.append(packet.getDestination())
-		buffer.append(packet.getSource())
-		buffer.append(packet.getType())
-		buffer += data
-		buffer.append(SimpleComm.calcCRC(buffer[2:]))
-
-		if has_aioserial and isinstance(stream, aioserial.Serial):
-			await stream.write_async(bytes(buffer))
-		else:
-			stream.write(bytes(buffer))
-
-	def send(stream, packet, destination = None, type = None):
-		packet.setSource(SimpleComm.getAddress())
-
-		if destination != None:
-			packet.setDestination(destination)
-
-		if type != None:
-			packet.setType(type)
-
-		data = packet.getData()
-		buffer = bytearray()
-		buffer.append(SimpleComm.SYN)
-		buffer.append(len(data) + 4)
-		buffer.append(packet.getDestination())
-		buffer.append(packet.getSource())
-		buffer.append(packet.getType())
-		buffer += data
-		buffer.append(SimpleComm.calcCRC(buffer[2:]))
-
-		stream.write(bytes(buffer))
-
-	async def async_receive(stream):
-		if isinstance(stream, aioserial.Serial):
-			stream_read_fun = stream.read_async
-		else:
-			stream_read_fun = stream.read
+		# Decode straight from the packet buffer, dropping the trailing null
+		end = SimplePacket._INDEX_DATA + self._dataLen() - 1
+		return str(memoryview(self._data)[SimplePacket._INDEX_DATA:end], encoding = "utf-8", errors = "ignore")
+
+	# The attributes packets used to store these in, kept working on top of
+	# the packet buffer. data is a copy, like getData()
+	source = property(getSource, setSource)
+	destination = property(getDestination, setDestination)
+	type = property(getType, setType)
+	data = property(getData, setData)
+
+	def release(self):
+		# The packet must not be used after this; a later receive may
+		# hand it out again. Releasing it twice would put it in the pool
+		# twice, so repeated releases are ignored
+		if self._released:
+			return
+		self._released = True
+		_packetPool.append(self)
+
+	def __enter__(self):
+		# The receive functions return None on timeout or end of stream,
+		# so check their result before using it in a with statement
+		return self
+
+	def __exit__(self, *exc):
+		self.release()
+
+	def _setSource(self, source):
+		# For addresses already normalized by setAddress
+		self._data[SimplePacket._INDEX_SOURCE] = source
+
+	def _setInteger(self, value, size, signed):
+		# Non-integers fail here with TypeError; struct.error is then only
+		# the value being out of range, which int.to_bytes() reported as
+		# OverflowError
+		value = operator.index(value)
 		try:
-			while True:
-				r = await stream_read_fun(1)
-				if len(r) == 0:
-					break
-
-				if r[0] != SimpleComm.SYN:
-					continue
-
-				r = await stream_read_fun(1)
-				if len(r) == 0:
-					break
-
-				tlen = r[0]
-				if tlen < 4:
-					continue
-
-				buffer = await stream_read_fun(tlen)
-				if len(buffer) != tlen:
-					break;
-
-				crc = SimpleComm.calcCRC(buffer[0:-1])
-				if crc != buffer[-1]:
-					continue
-
-				packet = SimplePacket()
-				packet.setDestination(buffer[0])
-				packet.setSource(buffer[1])
-				packet.setType(buffer[2])
-				packet.setData(buffer[3:-1])
-
-				return packet
-
-		except:
+			_integerStructs[size, bool(signed)].pack_into(self._data, SimplePacket._INDEX_DATA, value)
+		except struct.error as e:
+			raise OverflowError(e) from None
+		self._data[SimplePacket._INDEX_LEN] = size + 4
+
+	def _getInteger(self, size, signed):
+		# Shorter payloads are decoded as they are, like int.from_bytes() on
+		# the truncated data always did
+		if self._dataLen() < size:
+			return int.from_bytes(self.getData(), byteorder = "little", signed = signed)
+		return _integerStructs[size, bool(signed)].unpack_from(self._data, SimplePacket._INDEX_DATA)[0]
+
+	def _dataLen(self):
+		return self._data[SimplePacket._INDEX_LEN] - 4
+
+	def _buildFrame(self):
+		# Destination, source and type are already in place; only the CRC
+		# has to be written before handing out a view of the frame
+		tlen = self._data[SimplePacket._INDEX_LEN]
+		self._data[tlen + 1] = calcCRC(self._data, SimplePacket._INDEX_DESTINATION, tlen + 1)
+		return memoryview(self._data)[:tlen + 2]
+
+class _RxBuffer:
+	# Bytes read from a stream but not yet consumed by the frame parser.
+	# Reads are batched into it, so a frame costs one read instead of three.
+	# Those bytes outlive the receive call; after seeking, flushing or
+	# reading the stream directly, drop them with resetReceiveBuffer()
+	CHUNK_SIZE = 64
+	MANY_CHUNK_SIZE = 256
+
+	def __init__(self, batched = True):
+		self.buffer = bytearray()
+		self.pos = 0
+		self.need = 1
+		self.batched = batched
+		self.readAsync = None
+
+	def readSize(self, stream, chunkSize = None):
+		if not self.batched:
+			return self.need
+
+		# Serial ports report what is already waiting. On other streams
+		# (files, pipes, sockets) a larger read can block until it is
+		# filled, so only what the current frame needs is asked for,
+		# unless the caller knows reads return early (chunkSize)
+		waiting = getattr(stream, "in_waiting", None)
+		if waiting == None:
+			if chunkSize == None:
+				return self.need
+			return max(self.need, chunkSize)
+		return max(self.need, waiting)
+
+	def read(self, stream, chunkSize = CHUNK_SIZE):
+		# Buffered streams can still be read in chunks through read1(),
+		# which returns what one raw read gives instead of waiting for more
+		if self.batched and not hasattr(stream, "in_waiting") and hasattr(stream, "read1"):
+			return stream.read1(max(self.need, chunkSize))
+		return stream.read(self.readSize(stream))
+
+	def stalled(self, stream, data, need):
+		# Nothing more is coming for now: the stream ended, or a serial port
+		# timed out, which shows as a read shorter than what was asked for.
+		# Either way the call gives up, as a single read used to, and what
+		# was read stays buffered for the next call
+		return len(data) == 0 or (len(data) < need and hasattr(stream, "in_waiting"))
+
+	def feed(self, data):
+		if self.pos > 0:
+			del self.buffer[:self.pos]
+			self.pos = 0
+		self.buffer += data
+
+	def next(self):
+		buffer = self.buffer
+		pos, self.need = _findFrame(buffer, self.pos)
+		if self.need > 0:
+			self.pos = pos
 			return None
 
-		return None
-
-	def receive(stream):
+		frameEnd = pos + 2 + buffer[pos + 1]
+		# Every byte after SYN is overwritten, so a pooled packet needs
+		# no clearing
+		# The pool is shared between threads, so pop() is tried rather than
+		# checking for emptiness first
 		try:
-			while True:
-				r = stream.read(1)
-				if len(r) == 0:
-					break
-
-				if r[0] != SimpleComm.SYN:
-					continue
-
-				r = stream.read(1)
-				if len(r) == 0:
-					break
-
-				tlen = r[0]
-				if tlen < 4:
-					continue
-
-				buffer = stream.read(tlen)
-				if len(buffer) != tlen:
-					break;
+			packet = _packetPool.pop()
+			packet._released = False
+		except IndexError:
+			packet = SimplePacket()
+		packet._data[SimplePacket._INDEX_LEN:frameEnd - pos] = buffer[pos + 1:frameEnd]
+		self.pos = frameEnd
+		return packet
+
+	def flush(self):
+		# The stream has stalled, so the incomplete frame being waited for
+		# may be a stray SYN with a bogus length. Give up on it and return
+		# any complete frame buffered behind it
+		packet = self.next()
+		while packet == None and self.pos < len(self.buffer):
+			self.pos += 1
+			packet = self.next()
+		return packet
+
+	def flushMany(self, count):
+		packets = self.nextMany(count)
+		while len(packets) < count and self.pos < len(self.buffer):
+			self.pos += 1
+			packets += self.nextMany(count - len(packets))
+		return packets
+
+	def nextMany(self, count):
+		packets = []
+		while len(packets) < count:
+			packet = self.next()
+			if packet == None:
+				break
+			packets.append(packet)
+		return packets
+
+_address = 0
+_rxBuffers = weakref.WeakKeyDictionary()
+
+def setAddress(address):
+	global _address
+	_address = int(address)
+
+def getAddress():
+	return _address
+
+async def async_send(stream, packet, destination = None, type = None):
+	buffer = _buildFrame(packet, destination, type)
+
+	if has_aioserial and isinstance(stream, aioserial.Serial):
+		await stream.write_async(buffer)
+	else:
+		stream.write(buffer)
+
+def send(stream, packet, destination = None, type = None):
+	stream.write(_buildFrame(packet, destination, type))
+
+def _buildFrame(packet, destination, type):
+	packet._setSource(_address)
+
+	if destination != None:
+		packet.setDestination(destination)
+
+	if type != None:
+		packet.setType(type)
+
+	return packet._buildFrame()
+
+async def async_receive(stream):
+	rx = _getRxBuffer(stream)
+	stream_read_fun = _asyncReadFun(stream, rx)
+	try:
+		while True:
+			packet = rx.next()
+			if packet != None:
+				return packet
 
-				crc = SimpleComm.calcCRC(buffer[0:-1])
-				if crc != buffer[-1]:
-					continue
+			need = rx.need
+			r = await stream_read_fun(rx.readSize(stream))
+			rx.feed(r)
+			if rx.stalled(stream, r, need):
+				return rx.flush()
 
-				packet = SimplePacket()
-				packet.setDestination(buffer[0])
-				packet.setSource(buffer[1])
-				packet.setType(buffer[2])
-				packet.setData(buffer[3:-1])
+	except:
+		return None
 
+def receive(stream):
+	rx = _getRxBuffer(stream)
+	try:
+		while True:
+			packet = rx.next()
+			if packet != None:
 				return packet
 
-		except:
-			return None
+			need = rx.need
+			r = rx.read(stream)
+			rx.feed(r)
+			if rx.stalled(stream, r, need):
+				return rx.flush()
 
+	except:
 		return None
 
-	def calcCRC(buffer):
-		return sum(buffer) & 0xff
+async def async_receive_many(stream, max_packets = 16):
+	if max_packets < 1:
+		raise ValueError("max_packets must be at least 1")
+
+	rx = _getRxBuffer(stream)
+	stream_read_fun = _asyncReadFun(stream, rx)
+	# Async reads such as asyncio.StreamReader.read() return what is
+	# available instead of waiting for the full size
+	chunkSize = None if rx.readAsync else _RxBuffer.MANY_CHUNK_SIZE
+	try:
+		while True:
+			packets = rx.nextMany(max_packets)
+			if len(packets) > 0:
+				return packets
+
+			need = rx.need
+			r = await stream_read_fun(rx.readSize(stream, chunkSize))
+			rx.feed(r)
+			if rx.stalled(stream, r, need):
+				return rx.flushMany(max_packets)
+
+	except:
+		return []
+
+def receive_many(stream, max_packets = 16):
+	if max_packets < 1:
+		raise ValueError("max_packets must be at least 1")
+
+	rx = _getRxBuffer(stream)
+	try:
+		while True:
+			packets = rx.nextMany(max_packets)
+			if len(packets) > 0:
+				return packets
+
+			need = rx.need
+			r = rx.read(stream, _RxBuffer.MANY_CHUNK_SIZE)
+			rx.feed(r)
+			if rx.stalled(stream, r, need):
+				return rx.flushMany(max_packets)
+
+	except:
+		return []
+
+def resetReceiveBuffer(stream):
+	# Discards bytes read ahead from stream but not yet returned as packets
+	try:
+		_rxBuffers.pop(stream, None)
+	except TypeError:
+		# Such streams never keep a buffer between calls
+		pass
+
+def _asyncReadFun(stream, rx):
+	# The stream type does not change, so the isinstance() check is done
+	# once and remembered with the stream's receive buffer
+	if rx.readAsync == None:
+		rx.readAsync = has_aioserial and isinstance(stream, aioserial.Serial)
+
+	if rx.readAsync:
+		return stream.read_async
+	return stream.read
+
+def _getRxBuffer(stream):
+	try:
+		rx = _rxBuffers.get(stream)
+		if rx == None:
+			rx = _RxBuffer()
+			_rxBuffers[stream] = rx
+		return rx
+	except TypeError:
+		# Without a weak reference the buffer cannot outlive this call,
+		# so only read what the current frame needs, as a single read
+		# would, and never leave unparsed bytes behind
+		return _RxBuffer(batched = False)
+
+# Below this length building the numpy view costs more than sum() saves
+_KERNEL_CRC_MIN_LEN = 160
+
+_BUFFER_TYPES = (bytes, bytearray)
+
+def calcCRC(buffer, start = 0, end = None):
+	# Clamped like a slice, so the unchecked compiled kernels can never read
+	# outside the buffer and every path agrees on the result
+	start, end, _ = slice(start, end).indices(len(buffer))
+	n = end - start
+	if n <= 0:
+		return 0
+
+	# Plain iterables of ints are still accepted, through sum()
+	if _crcKernel != None and n >= _KERNEL_CRC_MIN_LEN and isinstance(buffer, _BUFFER_TYPES):
+		return int(_crcKernel(numpy.frombuffer(buffer, dtype = numpy.uint8), start, end))
+
+	# Frames are short, so copying the range is cheaper than summing
+	# through a memoryview
+	return sum(buffer[start:end]) & 0xff
+
+def _findFrame(buffer, pos):
+	# Returns the start of the next valid frame and 0, or the position to
+	# resume from and how many more bytes are needed
+	end = len(buffer)
+	while True:
+		pos = buffer.find(SYN, pos)
+		if pos < 0:
+			return end, 1
+
+		if pos + 2 > end:
+			return pos, pos + 2 - end
+
+		tlen = buffer[pos + 1]
+		frameEnd = pos + 2 + tlen
+		valid = tlen >= 4
+		if valid and frameEnd > end:
+			return pos, frameEnd - end
+
+		# A failed check only gives up this SYN: a real frame may start
+		# anywhere inside the bytes it claimed
+		if valid and calcCRC(buffer, pos + 2, frameEnd - 1) == buffer[frameEnd - 1]:
+			return pos, 0
+
+		pos += 1
+
+if has_fast:
+	calcCRC = _SimpleComm_fast.calcCRC
+	_findFrame = _SimpleComm_fast.findFrame
+
+class _SimpleCommType(type):
+	# SimpleComm.address used to be a plain class attribute; reads and
+	# writes of it are forwarded to the module-level address
+	address = property(lambda cls: getAddress(), lambda cls, address: setAddress(address))
+
+class SimpleComm(metaclass = _SimpleCommType):
+	# Kept for the SimpleComm.send(...) style API; the module-level
+	# functions are the implementation
+	SYN = SYN
+	address = property(lambda self: getAddress(), lambda self, address: setAddress(address))
+
+	def __init__(self, address = 0):
+		setAddress(address)
+
+	setAddress = staticmethod(setAddress)
+	getAddress = staticmethod(getAddress)
+	async_send = staticmethod(async_send)
+	send = staticmethod(send)
+	async_receive = staticmethod(async_receive)
+	receive = staticmethod(receive)
+	async_receive_many = staticmethod(async_receive_many)
+	receive_many = staticmethod(receive_many)
+	resetReceiveBuffer = staticmethod(resetReceiveBuffer)
+	calcCRC = staticmethod(calcCRC)
@@ -0,0 +1,61 @@
+# cython: language_level = 3
+# Compiled versions of SimpleComm.calcCRC and SimpleComm._findFrame, which
+# SimpleComm uses instead of its own when this module is built
+
+cimport cython
+from libc.string cimport memchr
+
+cdef unsigned char SYN = 0x02
+
+@cython.boundscheck(False)
+@cython.wraparound(False)
+cdef unsigned int _sum(const unsigned char[:] buffer, Py_ssize_t start, Py_ssize_t end) noexcept nogil:
+	cdef unsigned int s = 0
+	cdef Py_ssize_t i
+	for i in range(start, end):
+		s += buffer[i]
+	return s
+
+def calcCRC(buffer, start = 0, end = None):
+	# Same range semantics as SimpleComm.calcCRC
+	cdef const unsigned char[:] view
+	cdef Py_ssize_t first, last
+	first, last, _ = slice(start, end).indices(len(buffer))
+	if last <= first:
+		return 0
+
+	if not isinstance(buffer, (bytes, bytearray)):
+		return sum(buffer[first:last]) & 0xff
+
+	view = buffer
+	return _sum(view, first, last) & 0xff
+
+@cython.boundscheck(False)
+@cython.wraparound(False)
+def findFrame(const unsigned char[:] buffer, Py_ssize_t pos):
+	cdef Py_ssize_t end = buffer.shape[0]
+	cdef Py_ssize_t frameEnd
+	cdef unsigned char tlen
+	cdef const unsigned char *p
+
+	while pos < end:
+		p = <const unsigned char *> memchr(&buffer[pos], SYN, end - pos)
+		if p == NULL:
+			break
+		pos = p - &buffer[0]
+
+		if pos + 2 > end:
+			return pos, pos + 2 - end
+
+		tlen = buffer[pos + 1]
+		frameEnd = pos + 2 + tlen
+		if tlen >= 4:
+			if frameEnd > end:
+				return pos, frameEnd - end
+
+			if (_sum(buffer, pos + 2, frameEnd - 1) & 0xff) == buffer[frameEnd - 1]:
+				return pos, 0
+
+		pos += 1
+
+	return end, 1
@@ -0,0 +1,17 @@
+#!/usr/bin/env python3
+
+# Ahead-of-time compiles the CRC kernel of SimpleComm into the _SimpleComm_cc
+# extension module, so installs get a compiled CRC without depending on
+# numba at runtime (numpy is still needed)
+
+from numba.pycc import CC
+
+import SimpleComm
+
+cc = CC("_SimpleComm_cc")
+cc.verbose = True
+
+cc.export("crcSum", "i8(u1[::1], i8, i8)")(SimpleComm._crcSum)
+
+if __name__ == "__main__":
+	cc.compile()
@@ -1,6 +1,30 @@
 #!/usr/bin/env python3
 
+import os
+
 from distutils.core import setup
+from distutils.extension import Extension
+
+# The compiled extensions are only built when Cython or numba is available,
+# or, for _SimpleComm_fast, from the C file shipped in the sdist
+ext_modules = []
+has_cython = False
+try:
+	from Cython.Build import cythonize
+	has_cython = True
+except ModuleNotFoundError:
+	pass
+
+if has_cython and os.path.exists("_SimpleComm_fast.pyx"):
+	ext_modules += cythonize("_SimpleComm_fast.pyx")
+elif os.path.exists("_SimpleComm_fast.c"):
+	ext_modules.append(Extension("_SimpleComm_fast", [ "_SimpleComm_fast.c" ]))
+
+try:
+	from build_ext import cc
+	ext_modules.append(cc.distutils_extension())
+except ModuleNotFoundError:
+	pass
 
 setup(
 		name = "SimpleComm",
@@ -12,4 +36,5 @@ setup(
 		license = "LGPLv3",
 
 		py_modules = [ "SimpleComm" ],
+		ext_modules = ext_modules,
 		)